@@ -3,8 +3,13 @@ import os
 import time
 import sqlite3
 import hashlib
+import re
+import threading
+import queue
+from contextlib import contextmanager
 from pathlib import Path
-from datetime import datetime
+from datetime import date, datetime
+from functools import lru_cache
 
 import gspread
 from google.oauth2.service_account import Credentials
@@ -65,26 +70,101 @@ DATE_CANDIDATES = [
 
 DB_PATH = Path("rank.db")
 
+# Una sola conexión persistente de escritura (autocommit) protegida por un
+# lock, más un pool de conexiones de solo lectura para los handlers: con WAL
+# los lectores no bloquean al escritor ni entre sí.
+_CONN = None
+_db_lock = threading.Lock()
+READ_POOL_SIZE = 4
+_read_pool = queue.Queue()
+
+
+def _open_reader():
+    con = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True,
+                          check_same_thread=False, isolation_level=None)
+    con.execute("PRAGMA query_only=1")
+    return con
+
+
+def _has_legacy_key(con, table):
+    cols = [r[1] for r in con.execute(f"PRAGMA table_info({table})")]
+    return bool(cols) and "scope" not in cols
+
 
 def init_db():
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute("""
-            CREATE TABLE IF NOT EXISTS player_lastpos (
-                player TEXT PRIMARY KEY,
-                last_pos INTEGER NOT NULL,
-                updated_at REAL NOT NULL
-            )
-        """)
-        con.execute("""
-            CREATE TABLE IF NOT EXISTS movement_cache (
-                player TEXT PRIMARY KEY,
-                movement TEXT NOT NULL,
-                updated_at REAL NOT NULL
-            )
+    global _CONN
+    con = sqlite3.connect(DB_PATH, check_same_thread=False,
+                          isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-20000")
+    con.execute("BEGIN IMMEDIATE")
+    # tablas antiguas con clave combinada "scope::player" → se migran abajo
+    legacy = [t for t in ("player_lastpos", "movement_cache")
+              if _has_legacy_key(con, t)]
+    for t in legacy:
+        con.execute(f"ALTER TABLE {t} RENAME TO {t}_legacy")
+    # PK (scope, player): el B-tree permite leer un scope como rango
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS player_lastpos (
+            scope TEXT NOT NULL,
+            player TEXT NOT NULL,
+            last_pos INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (scope, player)
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS movement_cache (
+            scope TEXT NOT NULL,
+            player TEXT NOT NULL,
+            movement TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (scope, player)
+        )
+    """)
+    for t in legacy:
+        value_col = "last_pos" if t == "player_lastpos" else "movement"
+        con.execute(f"""
+            INSERT OR IGNORE INTO {t}(scope, player, {value_col}, updated_at)
+            SELECT substr(player, 1, instr(player, '::') - 1),
+                   substr(player, instr(player, '::') + 2),
+                   {value_col}, updated_at
+            FROM {t}_legacy WHERE instr(player, '::') > 0
         """)
-        con.execute(
-            """CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT NOT NULL)""")
-        con.commit()
+        con.execute(f"DROP TABLE {t}_legacy")
+    con.execute(
+        """CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT NOT NULL)""")
+    con.execute("COMMIT")
+    _CONN = con
+    # las de lectura se abren después: mode=ro exige que el archivo ya exista
+    for _ in range(READ_POOL_SIZE):
+        _read_pool.put(_open_reader())
+
+
+@contextmanager
+def read_conn():
+    con = _read_pool.get()
+    try:
+        yield con
+    finally:
+        _read_pool.put(con)
+
+
+@contextmanager
+def write_tx():
+    """Una sola transacción (un solo fsync) sobre la conexión de escritura."""
+    with _db_lock:
+        _CONN.execute("BEGIN IMMEDIATE")
+        # la conexión es persistente: nunca dejarla dentro de una transacción
+        try:
+            yield _CONN
+            _CONN.execute("COMMIT")
+        except BaseException:
+            if _CONN.in_transaction:
+                _CONN.execute("ROLLBACK")
+            raise
 
 
 init_db()
@@ -92,80 +172,84 @@ init_db()
 # ------------------------------- Utilidades ----------------------------------
 
 
+@lru_cache(maxsize=8192)
 def normalize_name(name):
     return " ".join((name or "").split()).strip().lower()
 
 
-def key_for(scope, player_key):
-    """Guarda/lee posiciones por contexto (scope) usando la misma tabla."""
-    return f"{scope}::{player_key}"
-
-
 def scope_from_meta(scope):
     return f"rank_hash:{scope}"
 
 
 def get_meta(k):
-    with sqlite3.connect(DB_PATH) as con:
+    with read_conn() as con:
         row = con.execute("SELECT v FROM meta WHERE k=?", (k,)).fetchone()
         return row[0] if row else None
 
 
-def set_meta(k, v):
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute("""
-            INSERT INTO meta(k, v) VALUES (?, ?)
-            ON CONFLICT(k) DO UPDATE SET v=excluded.v
-        """, (k, v))
-        con.commit()
+def set_meta(k, v, con=None):
+    if con is None:
+        with write_tx() as con:
+            return set_meta(k, v, con)
+    con.execute("""
+        INSERT INTO meta(k, v) VALUES (?, ?)
+        ON CONFLICT(k) DO UPDATE SET v=excluded.v
+    """, (k, v))
 
 
-def get_last_pos_map():
-    with sqlite3.connect(DB_PATH) as con:
-        return dict(con.execute("SELECT player, last_pos FROM player_lastpos").fetchall())
+def get_last_pos_map(scope):
+    with read_conn() as con:
+        return dict(con.execute(
+            "SELECT player, last_pos FROM player_lastpos WHERE scope=?", (scope,)).fetchall())
 
 
-def set_current_positions(curr_pos_map):
+def set_current_positions(scope, curr_pos_map, con=None):
+    if con is None:
+        with write_tx() as con:
+            return set_current_positions(scope, curr_pos_map, con)
     now = time.time()
-    with sqlite3.connect(DB_PATH) as con:
-        for player_key, pos in curr_pos_map.items():
-            con.execute("""
-                INSERT INTO player_lastpos(player, last_pos, updated_at)
-                VALUES (?, ?, ?)
-                ON CONFLICT(player) DO UPDATE SET
-                    last_pos=excluded.last_pos, updated_at=excluded.updated_at
-            """, (player_key, pos, now))
-        con.commit()
+    con.executemany("""
+        INSERT INTO player_lastpos(scope, player, last_pos, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(scope, player) DO UPDATE SET
+            last_pos=excluded.last_pos, updated_at=excluded.updated_at
+    """, [(scope, player_key, pos, now) for player_key, pos in curr_pos_map.items()])
 
 
-def get_movement_cache_map():
-    with sqlite3.connect(DB_PATH) as con:
-        return dict(con.execute("SELECT player, movement FROM movement_cache").fetchall())
+def get_movement_cache_map(scope):
+    with read_conn() as con:
+        return dict(con.execute(
+            "SELECT player, movement FROM movement_cache WHERE scope=?", (scope,)).fetchall())
 
 
-def set_movement_cache(mov_map):
+def set_movement_cache(scope, mov_map, con=None):
+    if con is None:
+        with write_tx() as con:
+            return set_movement_cache(scope, mov_map, con)
     now = time.time()
-    with sqlite3.connect(DB_PATH) as con:
-        for player_key, movement in mov_map.items():
-            con.execute("""
-                INSERT INTO movement_cache(player, movement, updated_at)
-                VALUES (?, ?, ?)
-                ON CONFLICT(player) DO UPDATE SET
-                    movement=excluded.movement, updated_at=excluded.updated_at
-            """, (player_key, movement, now))
-        con.commit()
+    con.executemany("""
+        INSERT INTO movement_cache(scope, player, movement, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(scope, player) DO UPDATE SET
+            movement=excluded.movement, updated_at=excluded.updated_at
+    """, [(scope, player_key, movement, now) for player_key, movement in mov_map.items()])
 
 
 def clear_movement_cache():
-    with sqlite3.connect(DB_PATH) as con:
+    with write_tx() as con:
         con.execute("DELETE FROM movement_cache")
-        con.commit()
 
 # --------------------------------- Helpers -----------------------------------
 
 
 def get_level(row):
-    s = str(row.get(LEVEL_FIELD, "")).strip()
+    return _parse_level(row.get(LEVEL_FIELD, ""))
+
+
+# los niveles se repiten mucho ("4,5", "5", ...): se parsean una sola vez
+@lru_cache(maxsize=1024, typed=True)
+def _parse_level(raw):
+    s = str(raw).strip()
     if not s:
         return 0.0
     s = s.replace(",", ".")
@@ -181,77 +265,121 @@ def sort_rows_by_level(rows):
 
 
 def hash_rank(rows_sorted):
-    parts = []
+    # SHA-256: el digest se guarda en meta y debe seguir siendo comparable
+    # con los ya persistidos. Se alimenta fila a fila (mismo digest que
+    # "|".join) sin armar la lista.
+    h = hashlib.sha256()
+    sep = b""
     for r in rows_sorted:
-        parts.append(
-            f"{normalize_name(r.get(NAME_FIELD, ''))}:{get_level(r):.3f}")
-    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+        h.update(sep)
+        h.update(
+            f"{normalize_name(r.get(NAME_FIELD, ''))}:{get_level(r):.3f}".encode("utf-8"))
+        sep = b"|"
+    return h.hexdigest()
 
 
-def build_pos_map(rows_sorted, scope="ALL"):
-    """Devuelve dos mapas: por clave combinada (scope::player) y por nombre (solo player)."""
-    by_scope = {}
+def build_pos_map(rows_sorted):
+    """Devuelve el mapa posición por nombre normalizado (player)."""
     by_name = {}
     for idx, r in enumerate(rows_sorted, start=1):
         name_key = normalize_name((r.get(NAME_FIELD) or ""))
-        by_scope[key_for(scope, name_key)] = idx
         by_name[name_key] = idx
-    return by_scope, by_name
+    return by_name
 
 
 def ensure_snapshot_and_movements(rows_sorted, scope="ALL"):
     """
     Calcula flechas SOLO en este 'scope' (vista).
-    - Guarda/lee posiciones snapshot por (scope::player) en las tablas existentes.
-    - Devuelve movement_map y pos_map **por nombre** (no combinadas) para enriquecer la vista.
+    - Guarda/lee posiciones snapshot por (scope, player) en las tablas existentes.
+    - Devuelve movement_map y pos_map **por nombre** para enriquecer la vista.
     """
-    pos_scope_map, pos_name_map = build_pos_map(rows_sorted, scope=scope)
+    pos_name_map = build_pos_map(rows_sorted)
     rank_key = scope_from_meta(scope)  # hash por scope
     new_hash = hash_rank(rows_sorted)
 
     old_hash = get_meta(rank_key)
-    if old_hash != new_hash:
-        last_map = get_last_pos_map()
-        movement_scope_map = {}
-        for combined_key, curr_pos in pos_scope_map.items():
-            last_pos = last_map.get(combined_key)
-            if last_pos is None:
-                mv = "none"
-            elif curr_pos < last_pos:
-                mv = "up"
-            elif curr_pos > last_pos:
-                mv = "down"
-            else:
-                mv = "same"
-            movement_scope_map[combined_key] = mv
-
-        # persistir
-        set_movement_cache(movement_scope_map)
-        set_current_positions(pos_scope_map)
-        set_meta(rank_key, new_hash)
-
-    # construir movement por NOMBRE usando el cache actual:
-    cache_all = get_movement_cache_map()
+    if old_hash == new_hash:
+        # movement por NOMBRE: solo las filas de este scope (range scan por PK)
+        return get_movement_cache_map(scope), pos_name_map
+
+    last_map = get_last_pos_map(scope)
+    cached_mv = get_movement_cache_map(scope)
     movement_by_name = {}
-    for combined_key, mv in cache_all.items():
-        # solo entradas de este scope
-        if not combined_key.startswith(f"{scope}::"):
-            continue
-        name_key = combined_key.split("::", 1)[1]
+    for name_key, curr_pos in pos_name_map.items():
+        last_pos = last_map.get(name_key)
+        if last_pos is None:
+            mv = "none"
+        elif curr_pos < last_pos:
+            mv = "up"
+        elif curr_pos > last_pos:
+            mv = "down"
+        else:
+            mv = "same"
         movement_by_name[name_key] = mv
 
+    # persistir solo lo que cambió, todo en una sola transacción
+    mv_changed = {k: mv for k, mv in movement_by_name.items()
+                  if cached_mv.get(k) != mv}
+    pos_changed = {k: pos for k, pos in pos_name_map.items()
+                   if last_map.get(k) != pos}
+    with write_tx() as con:
+        set_movement_cache(scope, mv_changed, con)
+        set_current_positions(scope, pos_changed, con)
+        set_meta(rank_key, new_hash, con)
+
     return movement_by_name, pos_name_map
 
 
+class RankedRow:
+    """
+    Fila del Sheet + campos de ranking de una vista, sin copiar el dict
+    original (que es compartido por el snapshot). Se lee igual que un dict:
+    r.get('Nombre del jugador'), r['_pos'], ...
+    """
+    __slots__ = ("row", "_pos", "_pos_overall", "_pos_cat", "cat", "_movement")
+    FIELDS = __slots__[1:]
+
+    def __init__(self, row, **fields):
+        if isinstance(row, RankedRow):
+            fields = {**row.fields(), **fields}
+            row = row.row
+        self.row = row
+        for k, v in fields.items():
+            setattr(self, k, v)
+
+    def fields(self):
+        return {k: getattr(self, k) for k in self.FIELDS if hasattr(self, k)}
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return self.row[key]
+
+    def __contains__(self, key):
+        if key in self.FIELDS:
+            return hasattr(self, key)
+        return key in self.row
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
 def enrich_view(rows_sorted_view, movement_map_by_name, pos_map_by_name):
     enriched = []
     for idx, r in enumerate(rows_sorted_view, start=1):
         key = normalize_name((r.get(NAME_FIELD) or ""))
-        r2 = dict(r)
-        r2["_pos"] = idx                       # posición dentro de ESTA vista
-        r2["_pos_overall"] = pos_map_by_name.get(key)
-        r2["_movement"] = movement_map_by_name.get(key, "none")
-        enriched.append(r2)
+        enriched.append(RankedRow(
+            r,
+            _pos=idx,                          # posición dentro de ESTA vista
+            _pos_overall=pos_map_by_name.get(key),
+            _movement=movement_map_by_name.get(key, "none"),
+        ))
     return enriched
 
 
@@ -260,6 +388,18 @@ def unique_nonempty(iterable):
     return sorted(s)
 
 
+@lru_cache(maxsize=1024, typed=True)
+def _norm_cat(raw):
+    return str(raw).strip().lower()
+
+
+@lru_cache(maxsize=1024, typed=True)
+def _is_female(g_raw, c_raw):
+    """Fila femenina si lo dice el GÉNERO o la categoría oficial."""
+    g = str(g_raw).strip().lower()
+    return ("fem" in g) or g == "f" or ("fem" in _norm_cat(c_raw))
+
+
 def filter_rows(rows, genero=None, official_cat=None):
     """
     Filtra por género y/o por categoría oficial.
@@ -267,20 +407,15 @@ def filter_rows(rows, genero=None, official_cat=None):
     - Para genero='F': incluye filas femeninas (en GÉNERO o en la categoría).
     """
     genero = (genero or "").strip().upper()
-    official_cat = (official_cat or "").strip()
+    official_cat = (official_cat or "").strip().lower()
+    want_female = (genero == "F") if genero in ("M", "F") else None
     out = []
     for r in rows:
-        g = str(r.get(GENDER_FIELD, "")).strip().lower()
-        c = str(r.get(OFFICIAL_CAT_FIELD, "")).strip().lower()
-
-        if genero == "M":
-            if ("fem" in g) or ("femen" in g) or ("fem" in c) or ("femen" in c) or g == "f":
-                continue
-        elif genero == "F":
-            if not (("fem" in g) or ("femen" in g) or ("fem" in c) or ("femen" in c) or g == "f"):
+        c_raw = r.get(OFFICIAL_CAT_FIELD, "")
+        if want_female is not None:
+            if _is_female(r.get(GENDER_FIELD, ""), c_raw) != want_female:
                 continue
-
-        if official_cat and c.lower() != official_cat.lower():
+        if official_cat and _norm_cat(c_raw) != official_cat:
             continue
         out.append(r)
     return out
@@ -294,11 +429,56 @@ DATE_PATTERNS = (
 )
 
 
+# Atajos sin excepciones para los formatos habituales del Sheet
+# (YYYY-MM-DD y DD/MM/YYYY, con hora opcional); el resto cae a strptime.
+_TIME_RE = r"(?:\s+(\d{1,2}):(\d{1,2})(?::(\d{1,2}))?)?$"
+_ISO_DATE_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})" + _TIME_RE)
+_DMY_DATE_RE = re.compile(r"^(\d{1,2})([/-])(\d{1,2})\2(\d{4})" + _TIME_RE)
+
+
+def _valid_time(h, mi, sec):
+    if h is None:
+        return True
+    return int(h) < 24 and int(mi) < 60 and int(sec or 0) < 60
+
+
+def _fast_date_key(s_try):
+    m = _ISO_DATE_RE.match(s_try)
+    if m:
+        if not _valid_time(*m.group(4, 5, 6)):
+            return None
+        candidates = [(m.group(1), m.group(2), m.group(3))]
+    else:
+        m = _DMY_DATE_RE.match(s_try)
+        if not m or not _valid_time(*m.group(5, 6, 7)):
+            return None
+        a, sep, b, y = m.group(1, 2, 3, 4)
+        if sep == "-":
+            # solo existe %d-%m-%Y, y sin hora
+            if m.group(5) is not None:
+                return None
+            candidates = [(y, b, a)]
+        else:
+            candidates = [(y, b, a), (y, a, b)]   # día/mes antes que mes/día
+    for y, mo, d in candidates:
+        mo, d = int(mo), int(d)
+        if 1 <= mo <= 12 and 1 <= d <= 31:
+            try:
+                return date(int(y), mo, d).isoformat()
+            except ValueError:
+                pass
+    return None
+
+
+@lru_cache(maxsize=4096)
 def _parse_date_key(raw):
     s = str(raw or "").strip()
     if not s:
         return ""
     s_try = s.replace("T", " ").strip()
+    dk = _fast_date_key(s_try)
+    if dk:
+        return dk
     for fmt in DATE_PATTERNS:
         try:
             dt = datetime.strptime(s_try, fmt)
@@ -317,18 +497,36 @@ def _parse_date_key(raw):
         return ""
 
 
+# columnas de fecha presentes, por firma de encabezado del Sheet
+_date_cols_by_header = {}
+
+
+def date_columns(rows):
+    """Candidatas de DATE_CANDIDATES que existen en el encabezado (en orden)."""
+    if not rows:
+        return ()
+    header = tuple(rows[0])
+    cols = _date_cols_by_header.get(header)
+    if cols is None:
+        present = set(header)
+        cols = tuple(c for c in DATE_CANDIDATES if c in present)
+        _date_cols_by_header[header] = cols
+    return cols
+
+
 def dedupe_best_per_day(rows):
     best = {}
     passthrough = []
+    date_cols = date_columns(rows)
     for r in rows:
         player_key = normalize_name(r.get(NAME_FIELD))
         day_key = ""
-        for cand in DATE_CANDIDATES:
-            if cand in r and str(r[cand]).strip():
-                dk = _parse_date_key(r[cand])
-                if dk:
-                    day_key = dk
-                    break
+        for cand in date_cols:
+            # _parse_date_key devuelve "" para celdas vacías o no parseables
+            dk = _parse_date_key(r.get(cand, ""))
+            if dk:
+                day_key = dk
+                break
         if not day_key:
             passthrough.append(r)
             continue
@@ -346,12 +544,39 @@ CATS_M = ['1ra', '2da', '2_3', '3ra', '4ta',
 CATS_F = ['1ra', 'A', 'B', 'C', 'D', 'E']
 
 
+# las categorías del Sheet son pocas (~10 valores): se canonizan una vez.
+# La clave incluye el tipo: get_all_records convierte celdas numéricas y
+# 2 / 2.0 / True no dan el mismo texto.
+_CANON_M_CACHE = {}
+_CANON_F_CACHE = {}
+
+# todos los replace de canon_cat_m en una sola pasada
+_CAT_M_TRANS = str.maketrans(
+    {"º": None, "°": None, "–": "-", "—": "-", "/": "-", " ": None})
+_CAT_F_TRANS = str.maketrans({".": None, "_": None, "-": None, " ": None})
+
+
 def canon_cat_m(raw):
-    s = (raw or "").strip().lower()
+    key = (type(raw), raw)
+    if key in _CANON_M_CACHE:
+        return _CANON_M_CACHE[key]
+    c = _CANON_M_CACHE[key] = _canon_cat_m(raw)
+    return c
+
+
+def canon_cat_f(raw):
+    key = (type(raw), raw)
+    if key in _CANON_F_CACHE:
+        return _CANON_F_CACHE[key]
+    c = _CANON_F_CACHE[key] = _canon_cat_f(raw)
+    return c
+
+
+def _canon_cat_m(raw):
+    s = str(raw or "").strip().lower()
     if not s:
         return None
-    s = s.replace("º", "").replace("°", "").replace(
-        "–", "-").replace("—", "-").replace("/", "-").replace(" ", "")
+    s = s.translate(_CAT_M_TRANS)
     if ("2" in s and "3" in s) or "2-3" in s or "2da3ra" in s or "2da-3ra" in s:
         return "2_3"
     if s.startswith("7"):
@@ -385,13 +610,13 @@ def canon_cat_m(raw):
     return None
 
 
-def canon_cat_f(raw):
-    s = (raw or "").strip().lower()
+def _canon_cat_f(raw):
+    s = str(raw or "").strip().lower()
     if not s:
         return None
-    for token in ["femenino", "categoria", "categoría", "cat", ".", "_", "-", " "]:
+    for token in ("femenino", "categoria", "categoría", "cat"):
         s = s.replace(token, "")
-    s = s.strip()
+    s = s.translate(_CAT_F_TRANS).strip()
     if s in {"1", "1a", "1ra", "primera", "open"}:
         return "1ra"
     if s in {"a"}:
@@ -416,46 +641,208 @@ def assign_buckets_from_sheet(rows_sorted, cats, genero=None):
         c0 = canon(r.get(OFFICIAL_CAT_FIELD))
         if c0 not in groups:
             c0 = cats[0]
-        r2 = dict(r)
-        r2['cat'] = c0
-        r2['_pos_cat'] = len(groups[c0]) + 1
-        groups[c0].append(r2)
+        groups[c0].append(RankedRow(r, cat=c0, _pos_cat=len(groups[c0]) + 1))
     default_cat = next((c for c in cats if groups[c]), cats[0])
     return groups, default_cat
 
-# -------------------------- Metadatos de chips (iconos) ----------------------
+# -------------- Snapshot procesado por versión del Sheet ---------------------
+
+# columnas que realmente usa el ranking; el resto de la fila no afecta el orden
+FINGERPRINT_FIELDS = (NAME_FIELD, LEVEL_FIELD, GENDER_FIELD,
+                      OFFICIAL_CAT_FIELD, *DATE_CANDIDATES)
 
+_scope_lock = threading.Lock()
 
-def cats_meta_m():
-    meta = {
-        "1ra": {"label": "1ra",        "value": "1ra", "img": "img/1ra.png", "alt": "Categoría 1ra"},
-        "2da": {"label": "2da",        "value": "2da", "img": "img/1ra.png", "alt": "Categoría 2da"},
-        "2_3": {"label": "2da - 3ra",  "value": "2_3", "img": "img/2_3.png", "alt": "Categoría 2da-3ra"},
-        "3ra": {"label": "3ra",        "value": "3ra", "img": "img/3ra.png", "alt": "Categoría 3ra"},
-        "4ta": {"label": "4ta",        "value": "4ta", "img": "img/4ta.png", "alt": "Categoría 4ta"},
-        "5ta": {"label": "5ta",        "value": "5ta", "img": "img/5ta.png", "alt": "Categoría 5ta"},
-        "6ta": {"label": "6ta",        "value": "6ta", "img": "img/6ta.png", "alt": "Categoría 6ta"},
-        "7ma": {"label": "7ma",        "value": "7ma", "img": "img/7ma.png", "alt": "Categoría 7ma"},
+
+def rows_fingerprint(rows):
+    data = tuple(tuple(r.get(f) for f in FINGERPRINT_FIELDS) for r in rows)
+    return hashlib.blake2b(repr(data).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def build_snapshot(rows, h):
+    # filtrar una lista ya ordenada conserva el orden (sort estable)
+    rows_all_sorted = sort_rows_by_level(dedupe_best_per_day(rows))
+    groups_m, _ = assign_buckets_from_sheet(
+        filter_rows(rows_all_sorted, genero="M"), CATS_M, genero="M")
+    groups_f, _ = assign_buckets_from_sheet(
+        filter_rows(rows_all_sorted, genero="F"), CATS_F, genero="F")
+    # categorías oficiales masculinas del Sheet (dropdown de /ranking)
+    cats_m = unique_nonempty(r.get(OFFICIAL_CAT_FIELD, "")
+                             for r in rows_all_sorted
+                             if str(r.get(GENDER_FIELD, "")).strip().upper() == "M")
+    return {
+        "source": rows,
+        "hash": h,
+        "rows_all_sorted": rows_all_sorted,
+        "groups_m": groups_m,
+        "groups_f": groups_f,
+        "cats_by_gender": {"M": cats_m, "F": list(CATS_F)},
+        # se llenan por scope la primera vez que se pide cada vista
+        "movement_maps_by_scope": {},
+        "pos_maps_by_scope": {},
+        "views_by_scope": {},
     }
-    # Devuelve ordenado según CATS_M
-    return [meta[k] for k in CATS_M if k in meta]
-
-
-def cats_meta_f():
-    return [
-        {"label": "Femenino 1ra", "value": "1ra",
-            "img": "img/feme1.png", "alt": "Femenino 1ra"},
-        {"label": "Femenino A", "value": "A",
-            "img": "img/femeA.png", "alt": "Femenino A"},
-        {"label": "Femenino B", "value": "B",
-            "img": "img/femeB.png", "alt": "Femenino B"},
-        {"label": "Femenino C", "value": "C",
-            "img": "img/femeC.png", "alt": "Femenino C"},
-        {"label": "Femenino D", "value": "D",
-            "img": "img/femeD.png", "alt": "Femenino D"},
-        {"label": "Femenino E", "value": "E",
-            "img": "img/femeE.png", "alt": "Femenino E"},
-    ]
+
+
+# snapshot vacío hasta la primera carga ("source" None = aún sin datos)
+_SNAPSHOT = {**build_snapshot([], None), "source": None}
+
+
+def get_snapshot(force=False):
+    """
+    Ranking ya deduplicado, ordenado y agrupado por categoría.
+    Solo se reconstruye si el Sheet trae contenido distinto en las columnas
+    relevantes; mientras el cache de get_rows no expire ni siquiera se hashea.
+    """
+    global _SNAPSHOT
+    rows = get_rows(force=force)
+    snap = _SNAPSHOT
+    if rows is snap["source"]:
+        return snap
+    h = rows_fingerprint(rows)
+    if h == snap["hash"]:
+        snap["source"] = rows
+        return snap
+    snap = build_snapshot(rows, h)
+    _SNAPSHOT = snap
+    return snap
+
+
+def snapshot_movements(snap, scope, rows_sorted):
+    """movement_map y pos_map del scope, calculados una vez por snapshot."""
+    if scope not in snap["movement_maps_by_scope"]:
+        # serializado: dos requests no deben comparar contra la misma foto vieja
+        with _scope_lock:
+            if scope not in snap["movement_maps_by_scope"]:
+                movement_map, pos_map = ensure_snapshot_and_movements(
+                    rows_sorted, scope=scope)
+                snap["pos_maps_by_scope"][scope] = pos_map
+                snap["movement_maps_by_scope"][scope] = movement_map
+    return snap["movement_maps_by_scope"][scope], snap["pos_maps_by_scope"][scope]
+
+
+def snapshot_view(snap, scope, rows_sorted):
+    """Filas enriquecidas del scope completo: las claves por jugador se arman
+    una vez por snapshot y no en cada request."""
+    view = snap["views_by_scope"].get(scope)
+    if view is None:
+        movement_map, pos_map = snapshot_movements(snap, scope, rows_sorted)
+        view = enrich_view(rows_sorted, movement_map, pos_map)
+        snap["views_by_scope"][scope] = view
+    return view
+
+# ------------------ Refresco del Sheet en segundo plano -----------------------
+
+# Un hilo trae el Sheet cada RANK_TTL segundos y reemplaza _SNAPSHOT; los
+# handlers solo leen el snapshot vigente (sin red). ?refresh=1 lo despierta.
+# Las filas crudas (get_rows → _cache) se publican aunque falle el ranking.
+_refresh_event = threading.Event()
+_first_load = threading.Event()
+_refresher = None
+_refresher_lock = threading.Lock()
+# último error al rearmar el snapshot; "since" = desde cuándo está desactualizado
+_rebuild_error = {"error": None, "since": None}
+
+
+def _refresher_loop():
+    while True:
+        try:
+            get_snapshot(force=True)
+            _rebuild_error.update(error=None, since=None)
+        except Exception as e:
+            app.logger.exception("Error refrescando el ranking: %s", e)
+            if _rebuild_error["since"] is None:
+                _rebuild_error["since"] = time.time()
+            _rebuild_error["error"] = e
+        _first_load.set()
+        _refresh_event.wait(RANK_TTL)
+        _refresh_event.clear()
+
+
+@app.before_request
+def start_refresher():
+    # se arranca con el primer request (no al importar) para no duplicarlo
+    # en el proceso vigilante del reloader de Flask
+    global _refresher
+    if _refresher is not None or RANK_TTL <= 0:
+        return
+    with _refresher_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(
+                target=_refresher_loop, name="sheet-refresher", daemon=True)
+            _refresher.start()
+
+
+def current_snapshot(refresh=False):
+    """Snapshot vigente; sin refresher (RANK_TTL=0) se trae el Sheet en línea."""
+    if _refresher is None:
+        return get_snapshot(force=refresh)
+    if refresh:
+        _refresh_event.set()
+    if _SNAPSHOT["source"] is None:
+        # arranque: esperar la primera carga del refresher en vez de traer
+        # el Sheet dos veces; solo si no llega a tiempo se trae aquí
+        if not _first_load.wait(RANK_TTL):
+            return get_snapshot()
+        if _SNAPSHOT["source"] is None:
+            raise RuntimeError(
+                "Ranking no disponible: falló la primera carga") from _rebuild_error["error"]
+    return _SNAPSHOT
+
+
+def current_rows(refresh=False):
+    """Filas crudas del Sheet; no dependen de que el ranking se pueda armar."""
+    if _refresher is None:
+        return get_rows(force=refresh)
+    if refresh:
+        _refresh_event.set()
+    if _cache["data"] is None and not _first_load.wait(RANK_TTL):
+        return get_rows()
+    return _cache["data"] or []
+
+
+@app.after_request
+def add_stale_ranking_header(response):
+    # el refresher no logra rearmar el ranking: se sirve el último snapshot
+    # bueno, pero se avisa en vez de ocultarlo
+    since = _rebuild_error["since"]
+    if since is not None and request.path.startswith("/ranking"):
+        response.headers["X-Ranking-Stale-Since"] = datetime.fromtimestamp(
+            since).isoformat(timespec="seconds")
+    return response
+
+# -------------------------- Metadatos de chips (iconos) ----------------------
+
+
+# Fijos: se arman una vez al importar, no en cada request
+_CATS_META_M_BY_KEY = {
+    "1ra": {"label": "1ra",        "value": "1ra", "img": "img/1ra.png", "alt": "Categoría 1ra"},
+    "2da": {"label": "2da",        "value": "2da", "img": "img/1ra.png", "alt": "Categoría 2da"},
+    "2_3": {"label": "2da - 3ra",  "value": "2_3", "img": "img/2_3.png", "alt": "Categoría 2da-3ra"},
+    "3ra": {"label": "3ra",        "value": "3ra", "img": "img/3ra.png", "alt": "Categoría 3ra"},
+    "4ta": {"label": "4ta",        "value": "4ta", "img": "img/4ta.png", "alt": "Categoría 4ta"},
+    "5ta": {"label": "5ta",        "value": "5ta", "img": "img/5ta.png", "alt": "Categoría 5ta"},
+    "6ta": {"label": "6ta",        "value": "6ta", "img": "img/6ta.png", "alt": "Categoría 6ta"},
+    "7ma": {"label": "7ma",        "value": "7ma", "img": "img/7ma.png", "alt": "Categoría 7ma"},
+}
+# ordenado según CATS_M
+CATS_META_M = tuple(_CATS_META_M_BY_KEY[k]
+                    for k in CATS_M if k in _CATS_META_M_BY_KEY)
+
+CATS_META_F = (
+    {"label": "Femenino 1ra", "value": "1ra",
+        "img": "img/feme1.png", "alt": "Femenino 1ra"},
+    {"label": "Femenino A", "value": "A",
+        "img": "img/femeA.png", "alt": "Femenino A"},
+    {"label": "Femenino B", "value": "B",
+        "img": "img/femeB.png", "alt": "Femenino B"},
+    {"label": "Femenino C", "value": "C",
+        "img": "img/femeC.png", "alt": "Femenino C"},
+    {"label": "Femenino D", "value": "D",
+        "img": "img/femeD.png", "alt": "Femenino D"},
+    {"label": "Femenino E", "value": "E",
+        "img": "img/femeE.png", "alt": "Femenino E"},
+)
 
 # -------------------------- Cache navegador: OFF ------------------------------
 
@@ -473,7 +860,7 @@ def add_no_cache_headers(response):
 
 @app.route("/")
 def home():
-    rows = get_rows(force=bool(request.args.get("refresh")))
+    rows = current_rows(refresh=bool(request.args.get("refresh")))
     return render_template("base.html", rows=rows)
 
 # relativegeneral (sin filtro)
@@ -481,29 +868,24 @@ def home():
 
 @app.route("/ranking")
 def ranking():
-    force = bool(request.args.get("refresh"))
+    refresh = bool(request.args.get("refresh"))
     genero = request.args.get("genero")
     cat = request.args.get("cat")
 
-    rows_all = get_rows(force=force)
-    rows_all = dedupe_best_per_day(rows_all)
-    rows_all_sorted = sort_rows_by_level(rows_all)
-
-    # Movimiento por scope = ALL (solo cambia si cambia POS general)
-    movement_map, pos_map = ensure_snapshot_and_movements(
-        rows_all_sorted, scope="ALL")
+    snap = current_snapshot(refresh=refresh)
+    rows_all_sorted = snap["rows_all_sorted"]
 
-    cats_m = unique_nonempty(r.get(OFFICIAL_CAT_FIELD, "")
-                             for r in rows_all
-                             if str(r.get(GENDER_FIELD, "")).strip().upper() == "M")
-    cats_by_gender = {"M": cats_m, "F": ["1ra", "A", "B", "C", "D", "E"]}
+    cats_by_gender = snap["cats_by_gender"]
 
+    # Movimiento por scope = ALL (solo cambia si cambia POS general)
     if genero or cat:
-        subset = filter_rows(rows_all, genero=genero, official_cat=cat)
-        subset_sorted = sort_rows_by_level(subset)
+        movement_map, pos_map = snapshot_movements(
+            snap, "ALL", rows_all_sorted)
+        subset_sorted = filter_rows(
+            rows_all_sorted, genero=genero, official_cat=cat)
         rows_view = enrich_view(subset_sorted, movement_map, pos_map)
     else:
-        rows_view = enrich_view(rows_all_sorted, movement_map, pos_map)
+        rows_view = snapshot_view(snap, "ALL", rows_all_sorted)
 
     view = {"genero": (genero or ""), "cat": (cat or "")}
     return render_template("ranking.html",
@@ -519,18 +901,11 @@ def ranking():
 
 @app.route("/ranking-masculino")
 def ranking_masculino():
-    force = bool(request.args.get("refresh"))
-    rows_all = get_rows(force=force)
-    rows_all = dedupe_best_per_day(rows_all)
-
-    # Solo masculino
-    rows_m = filter_rows(rows_all, genero="M")
-    rows_sorted_m = sort_rows_by_level(rows_m)
+    refresh = bool(request.args.get("refresh"))
+    snap = current_snapshot(refresh=refresh)
 
-    # Bucket por categorías (usa CATS_M con 1ra primero)
-    groups, _top_cat_ignored = assign_buckets_from_sheet(
-        rows_sorted_m, CATS_M, genero="M"
-    )
+    # Buckets masculinos por categoría (precalculados en el snapshot)
+    groups = snap["groups_m"]
 
     # Por defecto abre en 1ra
     current_cat = request.args.get("cat") or "1ra"
@@ -541,12 +916,10 @@ def ranking_masculino():
 
     # Movimiento por scope = M:<cat>
     scope = f"M:{current_cat}"
-    movement_map, pos_map = ensure_snapshot_and_movements(
-        rows_current, scope=scope)
-    rows_view = enrich_view(rows_current, movement_map, pos_map)
+    rows_view = snapshot_view(snap, scope, rows_current)
 
     # Meta de categorías (para el dropdown/chips)
-    cats = cats_meta_m()
+    cats = CATS_META_M
     # Etiqueta visible del botón (si usas {{ current_label }})
     current_label = next(
         (c["label"] for c in cats if c["value"] == current_cat), current_cat)
@@ -568,18 +941,11 @@ def ranking_masculino():
 
 @app.route("/ranking-femenino")
 def ranking_femenino():
-    force = bool(request.args.get("refresh"))
-    rows_all = get_rows(force=force)
-    rows_all = dedupe_best_per_day(rows_all)
+    refresh = bool(request.args.get("refresh"))
+    snap = current_snapshot(refresh=refresh)
 
-    # Solo femenino
-    rows_f = filter_rows(rows_all, genero="F")
-    rows_sorted_f = sort_rows_by_level(rows_f)
-
-    # Bucket por categorías femeninas
-    groups, _top_cat_ignored = assign_buckets_from_sheet(
-        rows_sorted_f, CATS_F, genero="F"
-    )
+    # Buckets femeninos por categoría (precalculados en el snapshot)
+    groups = snap["groups_f"]
 
     # Por defecto abre en 1ra
     current_cat = request.args.get("cat") or "1ra"
@@ -590,11 +956,9 @@ def ranking_femenino():
 
     # Movimiento por scope = F:<cat>
     scope = f"F:{current_cat}"
-    movement_map, pos_map = ensure_snapshot_and_movements(
-        rows_current, scope=scope)
-    rows_view = enrich_view(rows_current, movement_map, pos_map)
+    rows_view = snapshot_view(snap, scope, rows_current)
 
-    cats = cats_meta_f()
+    cats = CATS_META_F
     current_label = next(
         (c["label"] for c in cats if c["value"] == current_cat), current_cat)
 
@@ -615,7 +979,7 @@ def ranking_femenino():
 
 @app.route("/api/sesiones")
 def api_sesiones():
-    return jsonify(get_rows(force=bool(request.args.get("refresh"))))
+    return jsonify(current_rows(refresh=bool(request.args.get("refresh"))))
 
 
 # --------------------------------- Main --------------------------------------